@@ -14,6 +14,7 @@
 # limitations under the License.
 
 import asyncio
+import atexit
 import collections
 
 from absl.testing import absltest
@@ -35,6 +36,103 @@ from tensorflow_federated.python.core.impl.executors import thread_delegating_ex
 tf.compat.v1.enable_v2_behavior()
 
 
+_SERVER = placement_literals.SERVER
+_CLIENTS = placement_literals.CLIENTS
+
+_FLOAT32_AT_CLIENTS = type_factory.at_clients(tf.float32)
+
+_NUM_CLIENTS_PER_WORKER = 2
+_NUM_WORKERS = 6
+_NUM_CLIENTS = _NUM_CLIENTS_PER_WORKER * _NUM_WORKERS
+
+_TEST_TYPE = computation_types.NamedTupleType([
+    ('a', (tf.int32, tf.float32)),
+])
+
+_EXPECTED_ZIP_UNNAMED = anonymous_tuple.AnonymousTuple([(None, 10),
+                                                        (None, 20)])
+
+_EXPECTED_ZIP_NAMED = anonymous_tuple.AnonymousTuple([('A', 10), ('B', 20)])
+
+_MEAN_ARG = [float(x + 1) for x in range(_NUM_CLIENTS)]
+
+_MEAN_WEIGHT_ARG = [float(x % 3 + 1) for x in range(_NUM_CLIENTS)]
+
+_EXPECTED_AGGREGATE_NESTED = anonymous_tuple.AnonymousTuple([
+    ('a',
+     anonymous_tuple.AnonymousTuple([
+         (None, 10 * _NUM_CLIENTS + 5),
+         (None, 2.0 * _NUM_CLIENTS + 3.0),
+     ])),
+])
+
+
+@computations.tf_computation
+def _return_five():
+  return 5
+
+
+@computations.tf_computation(tf.int32)
+def _add_one(x):
+  return x + 1
+
+
+@computations.tf_computation(tf.int32)
+def _add_five(x):
+  return x + 5
+
+
+@computations.tf_computation(tf.int32, tf.int32)
+def _add_int(x, y):
+  return x + y
+
+
+@computations.tf_computation(_TEST_TYPE, _TEST_TYPE)
+def _add_test_type(x, y):
+  return collections.OrderedDict([
+      ('a', (x.a[0] + y.a[0], x.a[1] + y.a[1])),
+  ])
+
+
+@computations.tf_computation(_TEST_TYPE)
+def _add_five_and_three(x):
+  return collections.OrderedDict([('a', (x.a[0] + 5, x.a[1] + 3.0))])
+
+
+@computations.federated_computation
+def _zip_at_server_unnamed():
+  return intrinsics.federated_zip([
+      intrinsics.federated_value(10, _SERVER),
+      intrinsics.federated_value(20, _SERVER),
+  ])
+
+
+@computations.federated_computation
+def _zip_at_server_named():
+  return intrinsics.federated_zip(
+      collections.OrderedDict([
+          ('A', intrinsics.federated_value(10, _SERVER)),
+          ('B', intrinsics.federated_value(20, _SERVER)),
+      ]))
+
+
+@computations.federated_computation
+def _zip_at_clients_unnamed():
+  return intrinsics.federated_zip([
+      intrinsics.federated_value(10, _CLIENTS),
+      intrinsics.federated_value(20, _CLIENTS),
+  ])
+
+
+@computations.federated_computation
+def _zip_at_clients_named():
+  return intrinsics.federated_zip(
+      collections.OrderedDict([
+          ('A', intrinsics.federated_value(10, _CLIENTS)),
+          ('B', intrinsics.federated_value(20, _CLIENTS)),
+      ]))
+
+
 def _create_bottom_stack():
   return reference_resolving_executor.ReferenceResolvingExecutor(
       caching_executor.CachingExecutor(
@@ -43,10 +141,13 @@ def _create_bottom_stack():
 
 
 def _create_worker_stack():
+  server_stack = _create_bottom_stack()
   return federating_executor.FederatingExecutor({
-      placement_literals.SERVER: _create_bottom_stack(),
-      placement_literals.CLIENTS: [_create_bottom_stack() for _ in range(2)],
-      None: _create_bottom_stack()
+      _SERVER: server_stack,
+      _CLIENTS: [
+          _create_bottom_stack() for _ in range(_NUM_CLIENTS_PER_WORKER)
+      ],
+      None: server_stack
   })
 
 
@@ -57,279 +158,240 @@ def _create_middle_stack(children):
                                                children)))
 
 
+def _create_worker_stacks(num_workers):
+  return [_create_worker_stack() for _ in range(num_workers)]
+
+
 def _create_test_executor():
-  executor = _create_middle_stack([
-      _create_middle_stack([_create_worker_stack() for _ in range(3)]),
-      _create_middle_stack([_create_worker_stack() for _ in range(3)]),
+  workers = _create_worker_stacks(_NUM_WORKERS)
+  half = _NUM_WORKERS // 2
+  return _create_middle_stack([
+      _create_middle_stack(workers[:half]),
+      _create_middle_stack(workers[half:]),
   ])
-  # 2 clients per worker stack * 3 worker stacks * 2 middle stacks
-  num_clients = 12
-  return executor, num_clients
+
+
+def _create_flat_test_executor():
+  return _create_middle_stack(_create_worker_stacks(_NUM_WORKERS))
+
+
+_LOOP = asyncio.new_event_loop()
+asyncio.set_event_loop(_LOOP)
+atexit.register(_LOOP.close)
 
 
 def _invoke(ex, comp, arg=None):
-  loop = asyncio.get_event_loop()
-  v1 = loop.run_until_complete(ex.create_value(comp))
-  if arg is not None:
-    type_spec = v1.type_signature.parameter
-    v2 = loop.run_until_complete(ex.create_value(arg, type_spec))
-  else:
-    v2 = None
-  v3 = loop.run_until_complete(ex.create_call(v1, v2))
-  return loop.run_until_complete(v3.compute())
+
+  async def _invoke_async():
+    if arg is not None:
+      # The parameter type is known statically, so the argument can be embedded
+      # concurrently with the computation.
+      type_spec = comp.type_signature.parameter
+      v1, v2 = await asyncio.gather(
+          ex.create_value(comp), ex.create_value(arg, type_spec))
+    else:
+      v1 = await ex.create_value(comp)
+      v2 = None
+    v3 = await ex.create_call(v1, v2)
+    return await v3.compute()
+
+  return _LOOP.run_until_complete(_invoke_async())
 
 
 class ComposingExecutorTest(absltest.TestCase):
 
+  @classmethod
+  def setUpClass(cls):
+    super().setUpClass()
+    # The tests only read from the executor, so it is constructed once and
+    # shared across the whole test case.
+    cls.executor = _create_flat_test_executor()
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.executor.close()
+    super().tearDownClass()
+
   def test_federated_value_at_server(self):
 
     @computations.federated_computation
     def comp():
-      return intrinsics.federated_value(10, placement_literals.SERVER)
+      return intrinsics.federated_value(10, _SERVER)
 
-    executor, _ = _create_test_executor()
-    result = _invoke(executor, comp)
+    result = _invoke(self.executor, comp)
     self.assertEqual(result, 10)
 
   def test_federated_value_at_clients(self):
 
     @computations.federated_computation
     def comp():
-      return intrinsics.federated_value(10, placement_literals.CLIENTS)
+      return intrinsics.federated_value(10, _CLIENTS)
 
-    executor, _ = _create_test_executor()
-    result = _invoke(executor, comp)
+    result = _invoke(self.executor, comp)
     self.assertEqual(result, 10)
 
   def test_federated_eval_at_server(self):
 
     @computations.federated_computation
     def comp():
-      return_five = computations.tf_computation(lambda: 5)
-      return intrinsics.federated_eval(return_five, placement_literals.SERVER)
+      return intrinsics.federated_eval(_return_five, _SERVER)
 
-    executor, _ = _create_test_executor()
-    result = _invoke(executor, comp)
+    result = _invoke(self.executor, comp)
     self.assertEqual(result, 5)
 
   def test_federated_eval_at_clients(self):
 
     @computations.federated_computation
     def comp():
-      return_five = computations.tf_computation(lambda: 5)
-      return intrinsics.federated_eval(return_five, placement_literals.CLIENTS)
+      return intrinsics.federated_eval(_return_five, _CLIENTS)
 
-    executor, num_clients = _create_test_executor()
-    result = _invoke(executor, comp)
+    result = _invoke(self.executor, comp)
     self.assertIsInstance(result, list)
-    self.assertLen(result, num_clients)
+    self.assertLen(result, _NUM_CLIENTS)
     for x in result:
       self.assertEqual(x, 5)
 
   def test_federated_map(self):
 
-    @computations.tf_computation(tf.int32)
-    def add_one(x):
-      return x + 1
-
     @computations.federated_computation
     def comp():
-      value = intrinsics.federated_value(10, placement_literals.CLIENTS)
-      return intrinsics.federated_map(add_one, value)
-
-    executor, num_clients = _create_test_executor()
-    result = _invoke(executor, comp)
-    self.assertEqual(result, [10 + 1] * num_clients)
+      value = intrinsics.federated_value(10, _CLIENTS)
+      return intrinsics.federated_map(_add_one, value)
 
-  def test_federated_aggregate(self):
+    result = _invoke(self.executor, comp)
+    self.assertEqual(result, [10 + 1] * _NUM_CLIENTS)
 
-    @computations.tf_computation(tf.int32, tf.int32)
-    def add_int(x, y):
-      return x + y
-
-    @computations.tf_computation(tf.int32)
-    def add_five(x):
-      return x + 5
+  def test_federated_map_at_server(self):
 
     @computations.federated_computation
     def comp():
-      value = intrinsics.federated_value(10, placement_literals.CLIENTS)
-      return intrinsics.federated_aggregate(value, 0, add_int, add_int,
-                                            add_five)
-
-    executor, num_clients = _create_test_executor()
-    result = _invoke(executor, comp)
-    self.assertEqual(result, 10 * num_clients + 5)
+      value = intrinsics.federated_value(10, _SERVER)
+      return intrinsics.federated_map(_add_one, value)
 
-  def test_federated_aggregate_of_nested_tuple(self):
-    test_type = computation_types.NamedTupleType([
-        ('a', (tf.int32, tf.float32)),
-    ])
+    result = _invoke(self.executor, comp)
+    self.assertEqual(result, 10 + 1)
 
-    @computations.tf_computation(test_type, test_type)
-    def add_test_type(x, y):
-      return collections.OrderedDict([
-          ('a', (x.a[0] + y.a[0], x.a[1] + y.a[1])),
-      ])
+  def test_federated_zip_at_server_unnamed(self):
+    result = _invoke(self.executor, _zip_at_server_unnamed)
+    self.assertEqual(result, _EXPECTED_ZIP_UNNAMED)
 
-    @computations.tf_computation(test_type)
-    def add_five_and_three(x):
-      return collections.OrderedDict([('a', (x.a[0] + 5, x.a[1] + 3.0))])
+  def test_federated_zip_at_server_named(self):
+    result = _invoke(self.executor, _zip_at_server_named)
+    self.assertEqual(result, _EXPECTED_ZIP_NAMED)
 
-    @computations.federated_computation
-    def comp():
-      value = intrinsics.federated_value(
-          collections.OrderedDict([('a', (10, 2.0))]),
-          placement_literals.CLIENTS)
-      zero = collections.OrderedDict([('a', (0, 0.0))])
-      return intrinsics.federated_aggregate(value, zero, add_test_type,
-                                            add_test_type, add_five_and_three)
-
-    executor, num_clients = _create_test_executor()
-    result = _invoke(executor, comp)
-    excepted_result = anonymous_tuple.AnonymousTuple([
-        ('a',
-         anonymous_tuple.AnonymousTuple([
-             (None, 10 * num_clients + 5),
-             (None, 2.0 * num_clients + 3.0),
-         ])),
-    ])
-    self.assertEqual(result, excepted_result)
+  def test_federated_zip_at_clients_unnamed(self):
+    result = _invoke(self.executor, _zip_at_clients_unnamed)
+    for value in result:
+      self.assertEqual(value, _EXPECTED_ZIP_UNNAMED)
 
-  def test_federated_broadcast(self):
+  def test_federated_zip_at_clients_named(self):
+    result = _invoke(self.executor, _zip_at_clients_named)
+    for value in result:
+      self.assertEqual(value, _EXPECTED_ZIP_NAMED)
 
-    @computations.tf_computation(tf.int32)
-    def add_one(x):
-      return x + 1
+  def test_federated_sum(self):
 
     @computations.federated_computation
     def comp():
-      value_at_server = intrinsics.federated_value(10,
-                                                   placement_literals.SERVER)
-      value_at_clients = intrinsics.federated_broadcast(value_at_server)
-      return intrinsics.federated_map(add_one, value_at_clients)
+      value = intrinsics.federated_value(10, _CLIENTS)
+      return intrinsics.federated_sum(value)
 
-    executor, num_clients = _create_test_executor()
-    result = _invoke(executor, comp)
-    self.assertEqual(result, [10 + 1] * num_clients)
+    result = _invoke(self.executor, comp)
+    self.assertEqual(result, 10 * _NUM_CLIENTS)
 
-  def test_federated_map_at_server(self):
+  def test_federated_mean(self):
 
-    @computations.tf_computation(tf.int32)
-    def add_one(x):
-      return x + 1
+    @computations.federated_computation(_FLOAT32_AT_CLIENTS)
+    def comp(x):
+      return intrinsics.federated_mean(x)
 
-    @computations.federated_computation
-    def comp():
-      value = intrinsics.federated_value(10, placement_literals.SERVER)
-      return intrinsics.federated_map(add_one, value)
+    result = _invoke(self.executor, comp, _MEAN_ARG)
+    self.assertEqual(result, sum(_MEAN_ARG) / _NUM_CLIENTS)
 
-    executor, _ = _create_test_executor()
-    result = _invoke(executor, comp)
-    self.assertEqual(result, 10 + 1)
+  def test_federated_weighted_mean(self):
 
-  def test_federated_zip_at_server_unnamed(self):
+    @computations.federated_computation(_FLOAT32_AT_CLIENTS,
+                                        _FLOAT32_AT_CLIENTS)
+    def comp(x, y):
+      return intrinsics.federated_mean(x, y)
 
-    @computations.federated_computation
-    def comp():
-      return intrinsics.federated_zip([
-          intrinsics.federated_value(10, placement_literals.SERVER),
-          intrinsics.federated_value(20, placement_literals.SERVER),
-      ])
-
-    self.assertEqual(comp.type_signature.compact_representation(),
-                     '( -> <int32,int32>@SERVER)')
-    executor, _ = _create_test_executor()
-    result = _invoke(executor, comp)
-    excepted_result = anonymous_tuple.AnonymousTuple([(None, 10), (None, 20)])
-    self.assertEqual(result, excepted_result)
+    result = _invoke(self.executor, comp, (_MEAN_ARG, _MEAN_WEIGHT_ARG))
+    weighted_sum = sum(x * w for x, w in zip(_MEAN_ARG, _MEAN_WEIGHT_ARG))
+    expected = weighted_sum / sum(_MEAN_WEIGHT_ARG)
+    self.assertAlmostEqual(result, expected, places=3)
 
-  def test_federated_zip_at_server_named(self):
 
-    @computations.federated_computation
-    def comp():
-      return intrinsics.federated_zip(
-          collections.OrderedDict([
-              ('A', intrinsics.federated_value(10, placement_literals.SERVER)),
-              ('B', intrinsics.federated_value(20, placement_literals.SERVER)),
-          ]))
-
-    self.assertEqual(comp.type_signature.compact_representation(),
-                     '( -> <A=int32,B=int32>@SERVER)')
-    executor, _ = _create_test_executor()
-    result = _invoke(executor, comp)
-    excepted_result = anonymous_tuple.AnonymousTuple([('A', 10), ('B', 20)])
-    self.assertEqual(result, excepted_result)
+class NestedComposingExecutorTest(absltest.TestCase):
 
-  def test_federated_zip_at_clients_unnamed(self):
+  @classmethod
+  def setUpClass(cls):
+    super().setUpClass()
+    # These tests exercise traversal of a multi-level composing hierarchy.
+    cls.executor = _create_test_executor()
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.executor.close()
+    super().tearDownClass()
+
+  def test_federated_aggregate(self):
 
     @computations.federated_computation
     def comp():
-      return intrinsics.federated_zip([
-          intrinsics.federated_value(10, placement_literals.CLIENTS),
-          intrinsics.federated_value(20, placement_literals.CLIENTS),
-      ])
-
-    self.assertEqual(comp.type_signature.compact_representation(),
-                     '( -> {<int32,int32>}@CLIENTS)')
-    executor, _ = _create_test_executor()
-    result = _invoke(executor, comp)
-    for value in result:
-      excepted_value = anonymous_tuple.AnonymousTuple([(None, 10), (None, 20)])
-      self.assertEqual(value, excepted_value)
+      value = intrinsics.federated_value(10, _CLIENTS)
+      return intrinsics.federated_aggregate(value, 0, _add_int, _add_int,
+                                            _add_five)
 
-  def test_federated_zip_at_clients_named(self):
+    result = _invoke(self.executor, comp)
+    self.assertEqual(result, 10 * _NUM_CLIENTS + 5)
+
+  def test_federated_aggregate_of_nested_tuple(self):
 
     @computations.federated_computation
     def comp():
-      return intrinsics.federated_zip(
-          collections.OrderedDict([
-              ('A', intrinsics.federated_value(10, placement_literals.CLIENTS)),
-              ('B', intrinsics.federated_value(20, placement_literals.CLIENTS)),
-          ]))
-
-    self.assertEqual(comp.type_signature.compact_representation(),
-                     '( -> {<A=int32,B=int32>}@CLIENTS)')
-    executor, _ = _create_test_executor()
-    result = _invoke(executor, comp)
-    for value in result:
-      excepted_value = anonymous_tuple.AnonymousTuple([('A', 10), ('B', 20)])
-      self.assertEqual(value, excepted_value)
+      value = intrinsics.federated_value(
+          collections.OrderedDict([('a', (10, 2.0))]), _CLIENTS)
+      zero = collections.OrderedDict([('a', (0, 0.0))])
+      return intrinsics.federated_aggregate(value, zero, _add_test_type,
+                                            _add_test_type,
+                                            _add_five_and_three)
 
-  def test_federated_sum(self):
+    result = _invoke(self.executor, comp)
+    self.assertEqual(result, _EXPECTED_AGGREGATE_NESTED)
+
+  def test_federated_broadcast(self):
 
     @computations.federated_computation
     def comp():
-      value = intrinsics.federated_value(10, placement_literals.CLIENTS)
-      return intrinsics.federated_sum(value)
+      value_at_server = intrinsics.federated_value(10, _SERVER)
+      value_at_clients = intrinsics.federated_broadcast(value_at_server)
+      return intrinsics.federated_map(_add_one, value_at_clients)
 
-    executor, num_clients = _create_test_executor()
-    result = _invoke(executor, comp)
-    self.assertEqual(result, 10 * num_clients)
+    result = _invoke(self.executor, comp)
+    self.assertEqual(result, [10 + 1] * _NUM_CLIENTS)
 
-  def test_federated_mean(self):
 
-    @computations.federated_computation(type_factory.at_clients(tf.float32))
-    def comp(x):
-      return intrinsics.federated_mean(x)
+class ComposingExecutorTypeTest(absltest.TestCase):
 
-    executor, num_clients = _create_test_executor()
-    arg = [float(x + 1) for x in range(num_clients)]
-    result = _invoke(executor, comp, arg)
-    self.assertEqual(result, 6.5)
+  def test_federated_zip_at_server_unnamed_type_signature(self):
+    self.assertEqual(
+        _zip_at_server_unnamed.type_signature.compact_representation(),
+        '( -> <int32,int32>@SERVER)')
 
-  def test_federated_weighted_mean(self):
+  def test_federated_zip_at_server_named_type_signature(self):
+    self.assertEqual(
+        _zip_at_server_named.type_signature.compact_representation(),
+        '( -> <A=int32,B=int32>@SERVER)')
 
-    @computations.federated_computation(
-        type_factory.at_clients(tf.float32),
-        type_factory.at_clients(tf.float32))
-    def comp(x, y):
-      return intrinsics.federated_mean(x, y)
+  def test_federated_zip_at_clients_unnamed_type_signature(self):
+    self.assertEqual(
+        _zip_at_clients_unnamed.type_signature.compact_representation(),
+        '( -> {<int32,int32>}@CLIENTS)')
 
-    executor, num_clients = _create_test_executor()
-    arg = ([float(x + 1) for x in range(num_clients)], [1.0, 2.0, 3.0] * 4)
-    result = _invoke(executor, comp, arg)
-    self.assertAlmostEqual(result, 6.83333333333, places=3)
+  def test_federated_zip_at_clients_named_type_signature(self):
+    self.assertEqual(
+        _zip_at_clients_named.type_signature.compact_representation(),
+        '( -> {<A=int32,B=int32>}@CLIENTS)')
 
 
 if __name__ == '__main__':